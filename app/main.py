@@ -5,21 +5,38 @@
 # Админ-уведомления о активациях/деактивациях
 
 import os
-import json
+import queue
+import atexit
+import asyncio
+import threading
+import hashlib
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timezone, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from typing import Optional, List
 from pathlib import Path
+from functools import lru_cache
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.templating import Jinja2Templates
 import httpx
 import jwt
+import orjson
 import uuid
 import time
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Запись логов в stderr идёт в отдельном потоке: обработчики в event loop только кладут запись в очередь
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(_log_queue, _log_handler)
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(_log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 ROOT_PATH = os.getenv("ROOT_PATH", "/expensesms")
@@ -27,10 +44,31 @@ APP_ID = os.getenv("APP_ID", "")
 APP_SECRET = os.getenv("APP_SECRET", "")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
+# Сколько записей обрабатывать параллельно (МойСклад ограничивает число одновременных запросов)
+PROCESS_CONCURRENCY = int(os.getenv("PROCESS_CONCURRENCY", "5"))
+
 # Ник администратора для служебных уведомлений (например, "@kulps_dev")
 ADMIN_TELEGRAM_USERNAME = os.getenv("ADMIN_TELEGRAM_USERNAME", "@kulps_dev")
 
-app = FastAPI(title="Накладные расходы - МойСклад", root_path=ROOT_PATH)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_data_dir()
+    get_http_client()
+    yield
+    if _flush_task is not None:
+        await _flush_task
+    flush_pending_writes()
+    await close_http_client()
+
+
+app = FastAPI(
+    title="Накладные расходы - МойСклад",
+    root_path=ROOT_PATH,
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 templates = Jinja2Templates(directory="templates")
 
 DATA_DIR = Path("/app/data")
@@ -68,11 +106,70 @@ def now_msk() -> datetime:
     return datetime.now(MSK)
 
 
+def now_iso(now: Optional[datetime] = None) -> str:
+    """Отметка времени для JSON-файлов — с точностью до секунды"""
+    return (now or datetime.now(MSK)).isoformat(timespec="seconds")
+
+
 def get_currency_symbol(currency: str) -> str:
     """Получить символ валюты"""
     return CURRENCY_SYMBOLS.get(currency, currency)
 
 
+def parse_kopecks(value) -> int:
+    """Сумма в копейках без ошибок float ("10.10" -> 1010). Некорректное значение -> 0"""
+    try:
+        return int((Decimal(str(value or 0)) * 100).to_integral_value(rounding=ROUND_HALF_UP))
+    except (ArithmeticError, ValueError):
+        return 0
+
+
+async def read_json_body(request: Request):
+    """Тело запроса через orjson (request.json() разбирает стандартным json)"""
+    return orjson.loads(await request.body())
+
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_response(request: Request, body: bytes, media_type: str, cache_control: str,
+                  etag: Optional[str] = None) -> Response:
+    """Ответ с ETag; если у клиента та же версия (If-None-Match) — пустой 304"""
+    etag = etag or make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+# ============== HTTP-клиент ==============
+
+# Один клиент на процесс: keep-alive соединения к МойСклад и Telegram переиспользуются,
+# параллельные запросы мультиплексируются по HTTP/2
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=BASE_API_URL,
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            headers={"Accept-Encoding": "gzip"},
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 # ============== Хранилище ==============
 
 def ensure_data_dir():
@@ -80,21 +177,163 @@ def ensure_data_dir():
     LOGS_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# Разобранные JSON-файлы: path -> (mtime_ns, data). Файл перечитывается только после изменения
+_json_cache = {}
+
+
+# Отложенная запись: path -> (версия, данные), которые ещё не сброшены на диск
+_pending_writes = {}
+_write_version = 0
+_flush_handle: Optional[asyncio.TimerHandle] = None
+_flush_task: Optional[asyncio.Future] = None
+FLUSH_DELAY = 0.5
+# После неудачной записи повторяем с нарастающей паузой (до FLUSH_MAX_DELAY)
+FLUSH_MAX_DELAY = 30.0
+_flush_failures = 0
+
+
 def load_json(path: Path, default: dict) -> dict:
-    ensure_data_dir()
-    if path.exists():
+    if path in _pending_writes:
+        return _pending_writes[path][1]
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return default
+    cached = _json_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        data = orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.warning(f"⚠️ Не удалось прочитать {path.name}: {e}")
+        return default
+    _json_cache[path] = (mtime, data)
+    return data
+
+
+def dump_json(data: dict) -> bytes:
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
+
+# Запись идёт и из цикла событий, и из потока сброса — общий .tmp-файл нельзя писать одновременно
+_write_lock = threading.Lock()
+# Последняя запись каждого файла: path -> (mtime_ns, blake2b содержимого)
+_written_digests = {}
+
+
+def write_file_atomic(path: Path, body: bytes) -> int:
+    """Запись через временный файл + os.replace: при падении не остаётся обрезанного JSON"""
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+    with _write_lock:
+        last = _written_digests.get(path)
+        if last and last[1] == digest:
+            try:
+                mtime = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            # Файл не трогали с нашей записи и содержимое то же — переписывать нечего
+            if mtime == last[0]:
+                return mtime
+        with open(tmp, "wb") as f:
+            f.write(body)
+            f.flush()
+            # Данные на диске до переименования — после сбоя питания не останется пустого файла
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        mtime = path.stat().st_mtime_ns
+        _written_digests[path] = (mtime, digest)
+        return mtime
+
+
+def write_json(path: Path, data: dict):
+    _json_cache[path] = (write_file_atomic(path, dump_json(data)), data)
+
+
+def save_json(path: Path, data: dict, deferred: bool = False):
+    """
+    Сохранить JSON-файл.
+    deferred=True: данные сразу видны через load_json, а на диск пачка изменений
+    уходит одной записью через FLUSH_DELAY секунд в отдельном потоке.
+    """
+    global _write_version
+    if deferred:
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    return default
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None:
+            _write_version += 1
+            _pending_writes[path] = (_write_version, data)
+            schedule_flush(loop)
+            return
+    _pending_writes.pop(path, None)
+    write_json(path, data)
+
+
+def schedule_flush(loop: asyncio.AbstractEventLoop, delay: float = FLUSH_DELAY):
+    global _flush_handle
+    if _flush_handle is None:
+        _flush_handle = loop.call_later(delay, start_flush)
+
+
+def start_flush():
+    """Сериализовать ожидающие файлы в цикле событий и записать их в потоке"""
+    global _flush_handle, _flush_task
+    _flush_handle = None
+    if _flush_task is not None:
+        # Предыдущая пачка ещё пишется — она сама перезапустит сброс
+        return
+    batch = [(path, version, data, dump_json(data)) for path, (version, data) in _pending_writes.items()]
+    _flush_task = asyncio.ensure_future(flush_batch(batch))
 
 
-def save_json(path: Path, data: dict):
-    ensure_data_dir()
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def write_batch(batch) -> list:
+    written = []
+    for path, version, data, body in batch:
+        try:
+            mtime = write_file_atomic(path, body)
+        except OSError as e:
+            logger.error(f"❌ Не удалось записать {path.name}: {e}")
+            mtime = None
+        written.append((path, version, data, mtime))
+    return written
+
+
+async def flush_batch(batch):
+    global _flush_task, _flush_failures
+    failed = False
+    try:
+        for path, version, data, mtime in await asyncio.to_thread(write_batch, batch):
+            if mtime is None:
+                # Не записалось — данные остаются в очереди до следующей попытки
+                failed = True
+                continue
+            _json_cache[path] = (mtime, data)
+            # Если за время записи файл снова изменили — он останется в очереди
+            if _pending_writes.get(path, (None,))[0] == version:
+                del _pending_writes[path]
+    finally:
+        _flush_task = None
+        _flush_failures = _flush_failures + 1 if failed else 0
+        if _pending_writes:
+            delay = min(FLUSH_DELAY * 2 ** _flush_failures, FLUSH_MAX_DELAY)
+            schedule_flush(asyncio.get_running_loop(), delay)
+
+
+def flush_pending_writes():
+    """Синхронно записать всё, что осталось в очереди (при остановке)"""
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    for path, (_, data) in list(_pending_writes.items()):
+        try:
+            write_json(path, data)
+        except OSError as e:
+            logger.error(f"❌ Не удалось записать {path.name}: {e}")
+            continue
+        del _pending_writes[path]
 
 
 def load_accounts():
@@ -102,7 +341,9 @@ def load_accounts():
 
 
 def save_accounts(data):
-    save_json(ACCOUNTS_FILE, data)
+    global _active_accounts_cache
+    _active_accounts_cache = None
+    save_json(ACCOUNTS_FILE, data, deferred=True)
 
 
 def load_settings():
@@ -110,7 +351,7 @@ def load_settings():
 
 
 def save_settings(data):
-    save_json(SETTINGS_FILE, data)
+    save_json(SETTINGS_FILE, data, deferred=True)
 
 
 def load_context_map():
@@ -118,7 +359,7 @@ def load_context_map():
 
 
 def save_context_map(data):
-    save_json(CONTEXT_MAP_FILE, data)
+    save_json(CONTEXT_MAP_FILE, data, deferred=True)
 
 
 def load_telegram_users():
@@ -126,7 +367,7 @@ def load_telegram_users():
 
 
 def save_telegram_users(data):
-    save_json(TELEGRAM_USERS_FILE, data)
+    save_json(TELEGRAM_USERS_FILE, data, deferred=True)
 
 
 def load_user_settings():
@@ -134,7 +375,7 @@ def load_user_settings():
 
 
 def save_user_settings(data):
-    save_json(USER_SETTINGS_FILE, data)
+    save_json(USER_SETTINGS_FILE, data, deferred=True)
 
 
 # ============== Настройки пользователя ==============
@@ -148,18 +389,20 @@ def save_user_telegram(account_id: str, telegram_username: str):
     settings = load_user_settings()
     if "users" not in settings:
         settings["users"] = {}
+    if settings["users"].get(account_id, {}).get("telegram_username") == telegram_username:
+        return
     if account_id not in settings["users"]:
         settings["users"][account_id] = {}
     settings["users"][account_id]["telegram_username"] = telegram_username
-    settings["users"][account_id]["updated_at"] = now_msk().isoformat()
+    settings["users"][account_id]["updated_at"] = now_iso()
     save_user_settings(settings)
 
 
 # ============== Аккаунты ==============
 
-def save_account(account_id: str, account_data: dict):
+def save_account(account_id: str, account_data: dict, timestamp: Optional[str] = None):
     data = load_accounts()
-    account_data["updated_at"] = now_msk().isoformat()
+    account_data["updated_at"] = timestamp or now_iso()
     if "accounts" not in data:
         data["accounts"] = {}
     data["accounts"][account_id] = account_data
@@ -167,6 +410,20 @@ def save_account(account_id: str, account_data: dict):
     logger.info(f"💾 Сохранён аккаунт: {account_id} ({account_data.get('account_name')})")
 
 
+def patch_account(account_id: str, patch: dict, timestamp: Optional[str] = None) -> Optional[dict]:
+    """Изменить отдельные поля аккаунта. Если значения уже такие — файл не переписывается"""
+    data = load_accounts()
+    acc = data.get("accounts", {}).get(account_id)
+    if acc is None:
+        return None
+    if any(acc.get(key) != value for key, value in patch.items()):
+        acc.update(patch)
+        acc["updated_at"] = timestamp or now_iso()
+        save_accounts(data)
+    acc["account_id"] = account_id
+    return acc
+
+
 def get_account(account_id: str) -> Optional[dict]:
     acc = load_accounts().get("accounts", {}).get(account_id)
     if acc:
@@ -175,20 +432,33 @@ def get_account(account_id: str) -> Optional[dict]:
 
 
 def get_account_by_app_id(app_id: str) -> Optional[dict]:
-    for acc_id, acc in load_accounts().get("accounts", {}).items():
-        if acc.get("app_id") == app_id and acc.get("status") == "active" and acc.get("access_token"):
-            acc["account_id"] = acc_id
-            return acc
-    return None
+    return active_accounts_index()[2].get(app_id)
+
+
+# Активные аккаунты: (данные accounts, список, {app_id: аккаунт}). Пересобирается после
+# save_accounts или когда load_accounts вернул новый объект (файл изменился)
+_active_accounts_cache = None
+
+
+def active_accounts_index() -> tuple:
+    global _active_accounts_cache
+    data = load_accounts()
+    if _active_accounts_cache is None or _active_accounts_cache[0] is not data:
+        accounts = []
+        by_app_id = {}
+        for acc_id, acc in data.get("accounts", {}).items():
+            if acc.get("status") == "active" and acc.get("access_token"):
+                acc["account_id"] = acc_id
+                accounts.append(acc)
+                # При нескольких аккаунтах с одним app_id побеждает первый, как при переборе
+                by_app_id.setdefault(acc.get("app_id"), acc)
+        _active_accounts_cache = (data, accounts, by_app_id)
+    return _active_accounts_cache
 
 
 def get_all_active_accounts() -> List[dict]:
-    accounts = []
-    for acc_id, acc in load_accounts().get("accounts", {}).items():
-        if acc.get("status") == "active" and acc.get("access_token"):
-            acc["account_id"] = acc_id
-            accounts.append(acc)
-    return accounts
+    """Список активных аккаунтов с токеном. Общий для вызовов — не изменять"""
+    return active_accounts_index()[1]
 
 
 def get_dictionary_id(account_id: str) -> Optional[str]:
@@ -221,30 +491,68 @@ def save_telegram_user(username: str, chat_id: int):
         users["users"] = {}
     users["users"][username_clean] = {
         "chat_id": chat_id,
-        "registered_at": now_msk().isoformat()
+        "registered_at": now_iso()
     }
     save_telegram_users(users)
 
 
 # ============== Класс логирования ==============
 
-class ProcessingLog:
+class LogBuffer:
+    """
+    Строки журнала и результаты обработки.
+    При параллельной обработке у каждой записи свой буфер — он сливается
+    в общий ProcessingLog в исходном порядке записей.
+    """
+    def __init__(self, currency: str = "руб"):
+        self.currency = currency
+        self.lines = []
+        self.results = []
+        self.errors = []
+    
+    def log(self, message: str):
+        timestamp = now_msk().strftime("%H:%M:%S")
+        line = f"[{timestamp}] {message}"
+        self.lines.append(line)
+        # Построчный журнал уходит в файл лога; в консоль — только при уровне DEBUG
+        logger.debug(message)
+    
+    def log_success(self, doc_number: str, expense: float, total: float):
+        self.results.append({
+            "docNumber": doc_number,
+            "added": expense,
+            "total": total
+        })
+        self.log(f"✅ {doc_number} — добавлено {expense:,.2f} {self.currency} (итого: {total:,.2f} {self.currency})")
+    
+    def log_error(self, doc_number: str, expense: float, error: str):
+        self.errors.append({
+            "docNumber": doc_number,
+            "expense": expense,
+            "error": error
+        })
+        self.log(f"❌ {doc_number} — ОШИБКА: {error}")
+    
+    def log_search(self, doc_number: str, found: bool, details: str = ""):
+        if found:
+            self.log(f"🔍 {doc_number} — найден {details}")
+        else:
+            self.log(f"🔍 {doc_number} — НЕ НАЙДЕН {details}")
+
+
+class ProcessingLog(LogBuffer):
     def __init__(self, account_id: str, account_name: str, year: int, category: str, 
                  doc_type: str = "demand", currency: str = "руб"):
+        super().__init__(currency)
         self.account_id = account_id
         self.account_name = account_name
         self.year = year
         self.category = category
         self.doc_type = doc_type
-        self.currency = currency
         self.currency_symbol = get_currency_symbol(currency)
         self.started_at = now_msk()
-        self.lines = []
-        self.results = []
-        self.errors = []
         
-        doc_type_names = {'demand': 'Отгрузки', 'supply': 'Приёмки', 'move': 'Перемещения'}
-        self.doc_type_name = doc_type_names.get(doc_type, 'Документы')
+        self.doc_type_name = DOC_TYPE_NAMES.get(doc_type, 'Документы')
         
         timestamp = self.started_at.strftime("%Y%m%d_%H%M%S")
         self.log_filename = f"log_{account_id[:8]}_{doc_type}_{timestamp}.txt"
@@ -268,36 +576,13 @@ class ProcessingLog:
             "ЖУРНАЛ ОБРАБОТКИ:",
             "-" * 70,
         ]
+        # На диск журнал пишется целиком в finalize (из потока), а не из цикла событий
         self.lines.extend(header)
-        self._flush()
     
-    def log(self, message: str):
-        timestamp = now_msk().strftime("%H:%M:%S")
-        line = f"[{timestamp}] {message}"
-        self.lines.append(line)
-        logger.info(message)
-    
-    def log_success(self, doc_number: str, expense: float, total: float):
-        self.results.append({
-            "docNumber": doc_number,
-            "added": expense,
-            "total": total
-        })
-        self.log(f"✅ {doc_number} — добавлено {expense:,.2f} {self.currency} (итого: {total:,.2f} {self.currency})")
-    
-    def log_error(self, doc_number: str, expense: float, error: str):
-        self.errors.append({
-            "docNumber": doc_number,
-            "expense": expense,
-            "error": error
-        })
-        self.log(f"❌ {doc_number} — ОШИБКА: {error}")
-    
-    def log_search(self, doc_number: str, found: bool, details: str = ""):
-        if found:
-            self.log(f"🔍 {doc_number} — найден {details}")
-        else:
-            self.log(f"🔍 {doc_number} — НЕ НАЙДЕН {details}")
+    def merge(self, buffer: LogBuffer):
+        self.lines.extend(buffer.lines)
+        self.results.extend(buffer.results)
+        self.errors.extend(buffer.errors)
     
     def finalize(self) -> str:
         ended_at = now_msk()
@@ -338,7 +623,6 @@ class ProcessingLog:
         return "\n".join(self.lines)
     
     def _flush(self):
-        ensure_data_dir()
         with open(self.log_path, 'w', encoding='utf-8') as f:
             f.write("\n".join(self.lines))
     
@@ -395,17 +679,16 @@ async def send_telegram_message(chat_id: int, text: str, parse_mode: str = "HTML
     
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            resp = await client.post(url, json={
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": parse_mode
-            })
-            return resp.status_code == 200
-        except Exception as e:
-            logger.error(f"❌ Telegram error: {e}")
-            return False
+    try:
+        resp = await get_http_client().post(url, timeout=10.0, json={
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode
+        })
+        return resp.status_code == 200
+    except Exception as e:
+        logger.error(f"❌ Telegram error: {e}")
+        return False
 
 
 async def send_telegram_document(chat_id: int, file_content: str, filename: str, caption: str = ""):
@@ -414,15 +697,14 @@ async def send_telegram_document(chat_id: int, file_content: str, filename: str,
     
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendDocument"
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            files = {'document': (filename, file_content.encode('utf-8'), 'text/plain')}
-            data = {'chat_id': chat_id, 'caption': caption}
-            resp = await client.post(url, data=data, files=files)
-            return resp.status_code == 200
-        except Exception as e:
-            logger.error(f"❌ Telegram document error: {e}")
-            return False
+    try:
+        files = {'document': (filename, file_content.encode('utf-8'), 'text/plain')}
+        data = {'chat_id': chat_id, 'caption': caption}
+        resp = await get_http_client().post(url, data=data, files=files)
+        return resp.status_code == 200
+    except Exception as e:
+        logger.error(f"❌ Telegram document error: {e}")
+        return False
 
 
 async def notify_user_by_username(username: str, text: str):
@@ -461,22 +743,38 @@ async def notify_admin(text: str):
 
 # ============== Context Mapping ==============
 
+# Когда связка context_key -> аккаунт последний раз подтверждалась (только в памяти).
+# В файле created_at не обновляется на каждом запросе, а вытеснение должно убирать
+# давно не используемые ключи, а не давно созданные
+_context_last_seen = {}
+
+
 def save_context_mapping(context_key: str, account_id: str):
     if not context_key or not account_id:
         return
     acc = get_account(account_id)
     if not acc or acc.get("status") != "active":
         return
+    timestamp = now_iso()
+    _context_last_seen[context_key] = timestamp
     data = load_context_map()
+    account_name = acc.get("account_name", "")
+    current = data["map"].get(context_key)
+    if current and current.get("account_id") == account_id and current.get("account_name") == account_name:
+        # Та же связка уже сохранена — файл не переписываем на каждом запросе фронтенда
+        return
     data["map"][context_key] = {
         "account_id": account_id,
-        "account_name": acc.get("account_name", ""),
-        "created_at": now_msk().isoformat()
+        "account_name": account_name,
+        "created_at": timestamp
     }
     if len(data["map"]) > 10000:
-        sorted_keys = sorted(data["map"].keys(), key=lambda k: data["map"][k].get("created_at", ""))
+        def last_seen(k):
+            return max(_context_last_seen.get(k, ""), data["map"][k].get("created_at", ""))
+        sorted_keys = sorted(data["map"].keys(), key=last_seen)
         for k in sorted_keys[:len(sorted_keys) - 10000]:
             del data["map"][k]
+            _context_last_seen.pop(k, None)
     save_context_map(data)
 
 
@@ -491,6 +789,7 @@ def get_account_id_from_context(context_key: str) -> Optional[str]:
     acc = get_account(account_id)
     if not acc or acc.get("status") != "active" or not acc.get("access_token"):
         del data["map"][context_key]
+        _context_last_seen.pop(context_key, None)
         save_context_map(data)
         return None
     return account_id
@@ -519,43 +818,95 @@ async def get_context_from_moysklad(context_key: str) -> Optional[dict]:
         "Content-Type": "application/json",
         "Authorization": f"Bearer {jwt_token}"
     }
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        try:
-            resp = await client.post(url, headers=headers, json={})
-            if resp.status_code == 200:
-                return resp.json()
-        except Exception as e:
-            logger.error(f"❌ Context error: {e}")
+    try:
+        resp = await get_http_client().post(url, headers=headers, json={}, timeout=10.0)
+        if resp.status_code == 200:
+            return orjson.loads(resp.content)
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        logger.error(f"❌ Context error: {e}")
     return None
 
 
 # ============== API МойСклад ==============
 
-async def ms_api(method: str, endpoint: str, token: str, data: dict = None) -> dict:
-    url = f"{BASE_API_URL}{endpoint}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-        "Accept-Encoding": "gzip"
-    }
-    async with httpx.AsyncClient(timeout=30.0) as client:
+# Одновременные запросы к МойСклад на один токен (у API лимит параллельных запросов на пользователя)
+MS_CONCURRENCY = int(os.getenv("MS_CONCURRENCY", "5"))
+_ms_semaphores = {}
+
+
+def ms_semaphore(token: str) -> asyncio.Semaphore:
+    semaphore = _ms_semaphores.get(token)
+    if semaphore is None:
+        semaphore = _ms_semaphores[token] = asyncio.Semaphore(MS_CONCURRENCY)
+    return semaphore
+
+
+# Повторы при превышении лимита МойСклад (429) и временной недоступности (503)
+MS_RETRY_STATUSES = {429, 503}
+MS_MAX_RETRIES = 3
+MS_RETRY_MAX_DELAY = 5.0
+
+
+def ms_retry_delay(resp: httpx.Response, attempt: int) -> float:
+    """Пауза перед повтором: X-Lognex-Retry-TimeInterval (мс) или экспонента 0.5, 1, 2..."""
+    try:
+        delay = int(resp.headers["X-Lognex-Retry-TimeInterval"]) / 1000
+    except (KeyError, ValueError):
+        delay = 0.5 * 2 ** attempt
+    return min(delay, MS_RETRY_MAX_DELAY)
+
+
+@lru_cache(maxsize=256)
+def ms_auth_headers(token: str) -> dict:
+    """Заголовки собираются один раз на токен (тело запроса сериализуется orjson, см. ms_api)"""
+    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+
+
+async def ms_api(method: str, endpoint: str, token: str, data=None, parse_body: bool = True,
+                 params: Optional[dict] = None) -> dict:
+    """
+    Запрос к API МойСклад. Ответ — тело JSON со служебным полем _status.
+    parse_body=False: вызывающему нужен только статус, тело не разбирается.
+    params: параметры запроса, httpx сам их экранирует (номера документов с &, =, пробелами).
+    """
+    if method not in ("GET", "POST", "PUT"):
+        return {"_error": "Unknown method"}
+    headers = ms_auth_headers(token)
+    content = orjson.dumps(data) if method != "GET" else None
+    client = get_http_client()
+    try:
+        for attempt in range(MS_MAX_RETRIES + 1):
+            async with ms_semaphore(token):
+                resp = await client.request(method, endpoint, headers=headers, content=content, params=params)
+            if resp.status_code not in MS_RETRY_STATUSES or attempt == MS_MAX_RETRIES:
+                break
+            # Ждём вне семафора, чтобы не занимать слот других запросов
+            delay = ms_retry_delay(resp, attempt)
+            logger.warning(f"⏳ МойСклад {resp.status_code}, повтор через {delay:.1f} с: {method} {endpoint}")
+            await asyncio.sleep(delay)
+        if not parse_body:
+            return {"_status": resp.status_code}
         try:
-            if method == "GET":
-                resp = await client.get(url, headers=headers)
-            elif method == "POST":
-                resp = await client.post(url, headers=headers, json=data)
-            elif method == "PUT":
-                resp = await client.put(url, headers=headers, json=data)
-            else:
-                return {"_error": "Unknown method"}
-            try:
-                result = resp.json()
-            except:
-                result = {"_text": resp.text[:1000]}
-            result["_status"] = resp.status_code
-            return result
-        except Exception as e:
-            return {"_error": str(e), "_status": 0}
+            result = orjson.loads(resp.content)
+        except orjson.JSONDecodeError:
+            result = {"_text": resp.text[:1000]}
+        if not isinstance(result, dict):
+            # Массовые операции возвращают массив
+            result = {"_items": result}
+        result["_status"] = resp.status_code
+        return result
+    except httpx.HTTPError as e:
+        return {"_error": str(e), "_status": 0}
+
+
+def ms_error_text(result: dict) -> str:
+    """Короткий текст ошибки из ответа МойСклад — без сериализации всего ответа"""
+    messages = [e.get("error", "") for e in (result.get("errors") or [])[:3] if isinstance(e, dict)]
+    if any(messages):
+        return "; ".join(m for m in messages if m)
+    if result.get("_error"):
+        return result["_error"]
+    return f"HTTP {result.get('_status')}"
 
 
 # ============== Resolve Account ==============
@@ -610,88 +961,202 @@ async def resolve_account(request: Request) -> Optional[dict]:
 
 # ============== Справочник статей ==============
 
+# Незавершённые проверки/создания справочника по аккаунтам (single-flight)
+_dictionary_tasks: dict = {}
+
+# Проверенные справочники: account_id -> (expires_at, dict_id).
+# Пока запись жива, наличие справочника в МойСклад не перепроверяем
+DICTIONARY_TTL = 300.0
+_verified_dictionaries = {}
+
+
+def forget_dictionary(dict_id: str):
+    """Справочник пропал в МойСклад (404) — следующий вызов проверит/создаст его заново"""
+    for account_id, (_, cached_id) in list(_verified_dictionaries.items()):
+        if cached_id == dict_id:
+            del _verified_dictionaries[account_id]
+    _categories_cache.pop(dict_id, None)
+
+
 async def ensure_dictionary(token: str, account_id: str) -> Optional[str]:
+    """
+    Найти или создать справочник статей.
+    Параллельные вызовы для одного аккаунта ждут один общий запрос к МойСклад,
+    чтобы на холодном старте не создавать справочник несколько раз.
+    """
+    task = _dictionary_tasks.get(account_id)
+    if task is None:
+        task = asyncio.ensure_future(_ensure_dictionary(token, account_id))
+        _dictionary_tasks[account_id] = task
+        task.add_done_callback(lambda _: _dictionary_tasks.pop(account_id, None))
+    return await asyncio.shield(task)
+
+
+async def _ensure_dictionary(token: str, account_id: str) -> Optional[str]:
     dict_id = get_dictionary_id(account_id)
     if dict_id:
-        check = await ms_api("GET", f"/entity/customentity/{dict_id}", token)
+        cached = _verified_dictionaries.get(account_id)
+        if cached and cached[1] == dict_id and cached[0] > time.monotonic():
+            return dict_id
+        # Проверяем только существование — элементы справочника здесь не нужны
+        check = await ms_api("GET", f"/entity/customentity/{dict_id}?limit=1", token, parse_body=False)
         if check.get("_status") == 200:
+            _verified_dictionaries[account_id] = (time.monotonic() + DICTIONARY_TTL, dict_id)
             return dict_id
     
     result = await ms_api("POST", "/entity/customentity", token, {"name": DICTIONARY_NAME})
     if result.get("_status") in [200, 201] and result.get("id"):
         save_dictionary_id(account_id, result["id"])
+        _verified_dictionaries[account_id] = (time.monotonic() + DICTIONARY_TTL, result["id"])
         return result["id"]
     if result.get("_status") == 412:
         return get_dictionary_id(account_id)
     return None
 
 
+# Статьи меняются редко: dict_id -> (expires_at, categories, {имя в нижнем регистре: статья})
+CATEGORIES_TTL = 60.0
+CATEGORIES_PAGE_LIMIT = 1000
+_categories_cache = {}
+
+
 async def get_expense_categories(token: str, dict_id: str) -> List[dict]:
-    result = await ms_api("GET", f"/entity/customentity/{dict_id}", token)
+    cached = _categories_cache.get(dict_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    # Постранично: МойСклад отдаёт не больше 1000 элементов за запрос,
+    # а из каждой страницы сразу берём только id и name
     categories = []
-    if result.get("_status") == 200 and "rows" in result:
-        for elem in result["rows"]:
-            categories.append({"id": elem.get("id"), "name": elem.get("name")})
+    offset = 0
+    while True:
+        result = await ms_api("GET", f"/entity/customentity/{dict_id}?limit={CATEGORIES_PAGE_LIMIT}&offset={offset}", token)
+        if result.get("_status") != 200:
+            if result.get("_status") == 404:
+                forget_dictionary(dict_id)
+            return categories
+        rows = result.get("rows") or []
+        categories.extend({"id": elem.get("id"), "name": elem.get("name")} for elem in rows)
+        offset += len(rows)
+        if len(rows) < CATEGORIES_PAGE_LIMIT or offset >= result.get("meta", {}).get("size", 0):
+            break
+    by_name = {c["name"].lower(): c for c in categories if c.get("name")}
+    _categories_cache[dict_id] = (time.monotonic() + CATEGORIES_TTL, categories, by_name)
     return categories
 
 
+def find_cached_category(dict_id: str, name: str) -> Optional[dict]:
+    """Статья с таким именем из свежего кэша (без учёта регистра), без запроса к МойСклад"""
+    cached = _categories_cache.get(dict_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[2].get(name.lower())
+    return None
+
+
 async def add_expense_category(token: str, dict_id: str, name: str) -> Optional[dict]:
+    existing = find_cached_category(dict_id, name)
+    if existing:
+        return existing
     result = await ms_api("POST", f"/entity/customentity/{dict_id}", token, {"name": name})
     if result.get("_status") in [200, 201] and result.get("id"):
+        _categories_cache.pop(dict_id, None)
         return {"id": result["id"], "name": result.get("name", name)}
     if result.get("_status") == 412:
+        _categories_cache.pop(dict_id, None)
         return {"id": "exists", "name": name}
+    if result.get("_status") == 404:
+        forget_dictionary(dict_id)
     return None
 
 
 # ============== Поиск документов ==============
 
-async def search_document_exact(token: str, doc_type: str, name: str, year: int, log: ProcessingLog) -> dict:
+# Сколько документов запрашивать при поиске по номеру
+SEARCH_LIMIT = 100
+# Сколько номеров передавать в одном фильтре name=...;name=... (ограничение на длину URL)
+SEARCH_BULK_NAMES = 50
+# Максимальный размер страницы списка в МойСклад
+SEARCH_BULK_LIMIT = 1000
+# Сколько документов МойСклад принимает в одном массовом запросе
+BULK_UPDATE_LIMIT = 1000
+DISTRIBUTIONS = {"price", "weight", "volume"}
+
+DOC_ENDPOINTS = {
+    'demand': '/entity/demand',
+    'supply': '/entity/supply',
+    'move': '/entity/move'
+}
+DOC_NAMES = {
+    'demand': 'Отгрузка',
+    'supply': 'Приёмка',
+    'move': 'Перемещение'
+}
+DOC_TYPE_NAMES = {'demand': 'Отгрузки', 'supply': 'Приёмки', 'move': 'Перемещения'}
+
+
+def year_period(year: int) -> str:
+    return f"moment>{year}-01-01 00:00:00;moment<{year}-12-31 23:59:59"
+
+
+async def search_documents_bulk(token: str, doc_type: str, names: List[str], year: int,
+                                semaphore: asyncio.Semaphore) -> dict:
+    """
+    Точные совпадения для многих номеров сразу: name=A;name=B;... в МойСклад означает «или».
+    Возвращает {номер: документ}; ненайденные номера ищутся по одному через search_document_exact.
+    """
+    endpoint_base = DOC_ENDPOINTS.get(doc_type, '/entity/demand')
+    period = year_period(year)
+    # Точка с запятой — разделитель условий фильтра, такие номера ищем по одному
+    names = [name for name in names if ";" not in name]
+
+    async def fetch(chunk: List[str]) -> List[dict]:
+        name_filter = ";".join(f"name={name}" for name in chunk)
+        async with semaphore:
+            r = await ms_api("GET", endpoint_base, token,
+                             params={"filter": f"{name_filter};{period}", "limit": SEARCH_BULK_LIMIT})
+        return (r.get("rows") or []) if r.get("_status") == 200 else []
+
+    chunks = [names[i:i + SEARCH_BULK_NAMES] for i in range(0, len(names), SEARCH_BULK_NAMES)]
+    found = {}
+    for rows in await asyncio.gather(*(fetch(chunk) for chunk in chunks)):
+        for row in rows:
+            found.setdefault(row.get("name"), row)
+    return found
+
+
+def log_search_start(log: LogBuffer, doc_type: str, name: str, year: int):
+    log.log(f"🔍 Поиск {DOC_NAMES.get(doc_type, 'Документ')}: '{name}' за {year} год...")
+
+
+def search_found(name: str, document: dict, log: LogBuffer) -> dict:
+    log.log_search(name, True, f"(ID: {document.get('id')[:8]}...)")
+    return {"found": True, "document": document}
+
+
+async def search_document_exact(token: str, doc_type: str, name: str, year: int, log: LogBuffer) -> dict:
     """Точный поиск документа по номеру и году"""
-    date_from = f"{year}-01-01 00:00:00"
-    date_to = f"{year}-12-31 23:59:59"
+    endpoint_base = DOC_ENDPOINTS.get(doc_type, '/entity/demand')
+    doc_name_ru = DOC_NAMES.get(doc_type, 'Документ')
     
-    doc_endpoints = {
-        'demand': '/entity/demand',
-        'supply': '/entity/supply',
-        'move': '/entity/move'
-    }
-    doc_names = {
-        'demand': 'Отгрузка',
-        'supply': 'Приёмка',
-        'move': 'Перемещение'
-    }
+    log_search_start(log, doc_type, name, year)
     
-    endpoint_base = doc_endpoints.get(doc_type, '/entity/demand')
-    doc_name_ru = doc_names.get(doc_type, 'Документ')
+    # Один запрос с name~: в ответе и точное совпадение, и похожие номера для отчёта
+    period = year_period(year)
+    r = await ms_api("GET", endpoint_base, token, params={"filter": f"name~{name};{period}", "limit": SEARCH_LIMIT})
+    rows = (r.get("rows") or []) if r.get("_status") == 200 else []
     
-    log.log(f"🔍 Поиск {doc_name_ru}: '{name}' за {year} год...")
+    document = next((row for row in rows if row.get("name") == name), None)
     
-    # Точный поиск
-    endpoint = f"{endpoint_base}?filter=name={name};moment>{date_from};moment<{date_to}"
-    r = await ms_api("GET", endpoint, token)
+    # Страница заполнена целиком — точный номер мог в неё не попасть
+    if document is None and len(rows) >= SEARCH_LIMIT:
+        r2 = await ms_api("GET", endpoint_base, token, params={"filter": f"name={name};{period}"})
+        if r2.get("_status") == 200:
+            document = next((row for row in r2.get("rows") or [] if row.get("name") == name), None)
     
-    if r.get("_status") == 200 and r.get("rows"):
-        for row in r["rows"]:
-            if row.get("name") == name:
-                log.log_search(name, True, f"(ID: {row.get('id')[:8]}...)")
-                return {"found": True, "document": row}
-        
-        similar = [row.get("name") for row in r["rows"][:5]]
-        log.log_search(name, False, f"| Похожие: {', '.join(similar)}")
-        return {"found": False, "error": f"Точное совпадение не найдено. Похожие: {', '.join(similar)}"}
+    if document is not None:
+        return search_found(name, document, log)
     
-    # Поиск с ~
-    endpoint2 = f"{endpoint_base}?filter=name~{name};moment>{date_from};moment<{date_to}"
-    r2 = await ms_api("GET", endpoint2, token)
-    
-    if r2.get("_status") == 200 and r2.get("rows"):
-        for row in r2["rows"]:
-            if row.get("name") == name:
-                log.log_search(name, True, f"(ID: {row.get('id')[:8]}...)")
-                return {"found": True, "document": row}
-        
-        similar = [row.get("name") for row in r2["rows"][:5]]
+    if rows:
+        similar = [row.get("name") for row in rows[:5]]
         log.log_search(name, False, f"| Похожие: {', '.join(similar)}")
         return {"found": False, "error": f"Точное совпадение не найдено. Похожие: {', '.join(similar)}"}
     
@@ -699,75 +1164,71 @@ async def search_document_exact(token: str, doc_type: str, name: str, year: int,
     return {"found": False, "error": f"{doc_name_ru} не найден за {year} год"}
 
 
-async def update_document_overhead(
-    token: str,
-    doc_type: str,
-    doc_id: str,
-    add_sum: float,
-    category: str,
-    log: ProcessingLog,
-    currency: str = "руб",
-    distribution: str = "price"  # 'price' | 'weight' | 'volume'
-) -> dict:
-    """Обновить накладные расходы документа + выбрать способ распределения."""
-    doc_endpoints = {
-        'demand': '/entity/demand',
-        'supply': '/entity/supply',
-        'move': '/entity/move'
-    }
-    endpoint_base = doc_endpoints.get(doc_type, '/entity/demand')
-
-    allowed = {"price", "weight", "volume"}
-    distribution = (distribution or "price").strip().lower()
-    if distribution not in allowed:
-        distribution = "price"
-
-    document = await ms_api("GET", f"{endpoint_base}/{doc_id}", token)
-    if document.get("_status") != 200:
-        return {"success": False, "error": "Документ не найден"}
-
-    doc_name = document.get("name", "")
-    current_overhead = 0
-    overhead_data = document.get("overhead")
-    if overhead_data and overhead_data.get("sum"):
-        current_overhead = overhead_data.get("sum", 0)
-
-    new_overhead = current_overhead + int(add_sum * 100)
-    timestamp = now_msk().strftime("%d.%m.%Y %H:%M")
-
-    # Комментарий в документ
-    new_comment = f"[{timestamp}] +{add_sum:.2f} {currency} - {category} (распр.: {distribution})"
-    current_desc = document.get("description") or ""
-    new_desc = f"{current_desc}\n{new_comment}".strip()
-
-    update_data = {
-        "description": new_desc,
+def build_overhead_update(
+    document: dict,
+    entries: List[tuple],
+    currency: str,
+    distribution: str,
+    timestamp: str
+) -> tuple:
+    """
+    Собрать изменение накладных расходов документа для массового обновления.
+    entries — пары (копейки, статья) в порядке строк файла.
+    Возвращает тело для МойСклад и итог в копейках после каждой строки.
+    """
+    total = (document.get("overhead") or {}).get("sum") or 0
+    lines = [document.get("description") or ""]
+    totals = []
+    for add_kopecks, category in entries:
+        total += add_kopecks
+        totals.append(total)
+        # Комментарий в документ
+        lines.append(f"[{timestamp}] +{add_kopecks / 100:.2f} {currency} - {category} (распр.: {distribution})")
+
+    update = {
+        "meta": document["meta"],
+        "description": "\n".join(lines).strip(),
         "overhead": {
-            "sum": new_overhead,
+            "sum": total,
             "distribution": distribution
         }
     }
+    return update, totals
 
-    log.log(
-        f"📝 Обновление {doc_name}: +{add_sum:.2f} {currency} "
-        f"(было: {current_overhead/100:.2f} {currency}), распределение={distribution}"
-    )
 
-    result = await ms_api("PUT", f"{endpoint_base}/{doc_id}", token, update_data)
+async def bulk_update_documents(token: str, doc_type: str, updates: List[dict]) -> List[Optional[str]]:
+    """
+    Массовое обновление: массив изменений одним POST на /entity/<тип>.
+    Возвращает ошибку для каждого документа (None — обновлён).
+    """
+    endpoint_base = DOC_ENDPOINTS.get(doc_type, '/entity/demand')
+
+    errors = []
+    for start in range(0, len(updates), BULK_UPDATE_LIMIT):
+        chunk = updates[start:start + BULK_UPDATE_LIMIT]
+        result = await ms_api("POST", endpoint_base, token, chunk)
+        items = result.get("_items")
+        if result.get("_status") != 200 or not isinstance(items, list) or len(items) != len(chunk):
+            errors.extend([ms_error_text(result)] * len(chunk))
+            continue
+        errors.extend(ms_error_text(item) if "errors" in item else None for item in items)
+    return errors
 
-    if result.get("_status") == 200:
-        return {"success": True, "doc_name": doc_name, "added": add_sum, "total": new_overhead / 100}
 
-    return {"success": False, "error": str(result)}
+# ============== Vendor API ==============
 
+# МойСклад опрашивает статус часто, а вариантов ответа всего два
+STATUS_ACTIVATED = Response(content=orjson.dumps({"status": "Activated"}), media_type="application/json")
+STATUS_SETTINGS_REQUIRED = Response(content=orjson.dumps({"status": "SettingsRequired"}), media_type="application/json")
 
-# ============== Vendor API ==============
 
 @app.put("/api/moysklad/vendor/1.0/apps/{app_id}/{account_id}")
 async def activate_app(app_id: str, account_id: str, request: Request):
-    body = await request.json()
+    body = await read_json_body(request)
     account_name = body.get("accountName", "")
     logger.info(f"🟢 АКТИВАЦИЯ: {account_name} ({account_id})")
+    now = now_msk()
+    timestamp = now_iso(now)
     
     token = None
     for acc in body.get("access", []):
@@ -775,14 +1236,19 @@ async def activate_app(app_id: str, account_id: str, request: Request):
             token = acc["access_token"]
             break
     
+    # Повторная активация с новым токеном — семафор старого токена больше не нужен
+    previous = get_account(account_id)
+    if previous and previous.get("access_token") and previous["access_token"] != token:
+        _ms_semaphores.pop(previous["access_token"], None)
+    
     save_account(account_id, {
         "app_id": app_id,
         "account_id": account_id,
         "account_name": account_name,
         "status": "active",
         "access_token": token,
-        "activated_at": now_msk().isoformat(),
-    })
+        "activated_at": timestamp,
+    }, timestamp)
     
     if token:
         dict_id = await ensure_dictionary(token, account_id)
@@ -800,32 +1266,38 @@ async def activate_app(app_id: str, account_id: str, request: Request):
             f"🧩 App ID: <code>{app_id}</code>",
             "",
             f"📊 Сейчас активных аккаунтов: <b>{len(active_accounts)}</b>",
-            f"⏰ {now_msk().strftime('%d.%m.%Y %H:%M:%S')}",
+            f"⏰ {now.strftime('%d.%m.%Y %H:%M:%S')}",
         ]
         create_task(notify_admin("\n".join(msg_lines)))
     except Exception as e:
         logger.error(f"Не удалось отправить уведомление админу об активации: {e}")
     
-    return JSONResponse({"status": "Activated"})
+    return STATUS_ACTIVATED
 
 
 @app.delete("/api/moysklad/vendor/1.0/apps/{app_id}/{account_id}")
 async def deactivate_app(app_id: str, account_id: str, request: Request):
-    body = await request.json()
+    body = await read_json_body(request)
     logger.info(f"🔴 ДЕАКТИВАЦИЯ: {body.get('accountName', '')} ({account_id})")
+    now = now_msk()
+    timestamp = now_iso(now)
     
     acc = get_account(account_id)
     if acc:
-        acc["status"] = "inactive"
-        acc["access_token"] = None
-        acc["deactivated_at"] = now_msk().isoformat()
-        save_account(account_id, acc)
+        _ms_semaphores.pop(acc.get("access_token"), None)
+        acc = patch_account(account_id, {
+            "status": "inactive",
+            "access_token": None,
+            "deactivated_at": timestamp,
+        }, timestamp)
     
     context_map = load_context_map()
     keys_to_remove = [k for k, v in context_map.get("map", {}).items() if v.get("account_id") == account_id]
-    for k in keys_to_remove:
-        del context_map["map"][k]
-    save_context_map(context_map)
+    if keys_to_remove:
+        for k in keys_to_remove:
+            del context_map["map"][k]
+            _context_last_seen.pop(k, None)
+        save_context_map(context_map)
 
     # Админ-уведомление о деактивации
     try:
@@ -843,7 +1315,7 @@ async def deactivate_app(app_id: str, account_id: str, request: Request):
             reason_text,
             "",
             f"📊 После деактивации активных аккаунтов: <b>{len(active_accounts)}</b>",
-            f"⏰ {now_msk().strftime('%d.%m.%Y %H:%M:%S')}",
+            f"⏰ {now.strftime('%d.%m.%Y %H:%M:%S')}",
         ]
         # Уберём пустые строки от reason_text
         msg = "\n".join([line for line in msg_lines if line != ""])
@@ -851,14 +1323,13 @@ async def deactivate_app(app_id: str, account_id: str, request: Request):
     except Exception as e:
         logger.error(f"Не удалось отправить уведомление админу о деактивации: {e}")
     
-    return JSONResponse(status_code=200, content={})
+    return ORJSONResponse(status_code=200, content={})
 
 
 @app.get("/api/moysklad/vendor/1.0/apps/{app_id}/{account_id}/status")
 async def get_status(app_id: str, account_id: str):
     acc = get_account(account_id)
-    status = "Activated" if acc and acc.get("status") == "active" else "SettingsRequired"
-    return JSONResponse({"status": status})
+    return STATUS_ACTIVATED if acc and acc.get("status") == "active" else STATUS_SETTINGS_REQUIRED
 
 
 # ============== Telegram Webhook ==============
@@ -866,10 +1337,10 @@ async def get_status(app_id: str, account_id: str):
 @app.post("/api/telegram/webhook")
 async def telegram_webhook(request: Request):
     try:
-        data = await request.json()
+        data = await read_json_body(request)
         message = data.get("message", {})
         if not message:
-            return JSONResponse({"ok": True})
+            return ORJSONResponse({"ok": True})
         
         chat_id = message.get("chat", {}).get("id")
         username = message.get("from", {}).get("username", "")
@@ -896,40 +1367,49 @@ async def telegram_webhook(request: Request):
                     "Установите username в настройках и попробуйте снова."
                 )
         
-        return JSONResponse({"ok": True})
+        return ORJSONResponse({"ok": True})
     except Exception as e:
         logger.error(f"❌ Telegram webhook error: {e}")
-        return JSONResponse({"ok": True})
+        return ORJSONResponse({"ok": True})
 
 
 # ============== API для фронтенда ==============
 
+# Фронтенд перезапрашивает списки при каждом открытии — без изменений отдаём 304.
+# no-cache: браузер обязан перепроверить, иначе новая статья появится не сразу
+API_CACHE_CONTROL = "private, no-cache"
+
+
+def json_etag_response(request: Request, payload: dict) -> Response:
+    return etag_response(request, orjson.dumps(payload), "application/json", API_CACHE_CONTROL)
+
+
 @app.get("/api/expense-categories")
 async def api_get_categories(request: Request):
     acc = await resolve_account(request)
     
     if not acc:
         all_accounts = get_all_active_accounts()
-        return JSONResponse({
+        return ORJSONResponse({
             "categories": [],
             "error": f"Не удалось определить аккаунт ({len(all_accounts)} активных)",
             "needsReinstall": len(all_accounts) == 0,
         }, status_code=400)
     
     if not acc.get("access_token"):
-        return JSONResponse({"categories": [], "error": "Нет токена"}, status_code=401)
+        return ORJSONResponse({"categories": [], "error": "Нет токена"}, status_code=401)
     
     token = acc["access_token"]
     account_id = acc["account_id"]
     
     dict_id = await ensure_dictionary(token, account_id)
     if not dict_id:
-        return JSONResponse({"categories": [], "error": "Не удалось создать справочник"})
+        return ORJSONResponse({"categories": [], "error": "Не удалось создать справочник"})
     
     categories = await get_expense_categories(token, dict_id)
     saved_telegram = get_user_telegram(account_id)
     
-    return JSONResponse({
+    return json_etag_response(request, {
         "categories": categories,
         "accountId": account_id,
         "accountName": acc.get("account_name"),
@@ -939,53 +1419,53 @@ async def api_get_categories(request: Request):
 
 @app.post("/api/expense-categories")
 async def api_add_category(request: Request):
-    body = await request.json()
+    body = await read_json_body(request)
     name = body.get("name", "").strip()
     if not name:
-        return JSONResponse({"success": False, "error": "Название не указано"})
+        return ORJSONResponse({"success": False, "error": "Название не указано"})
     
     acc = await resolve_account(request)
     if not acc or not acc.get("access_token"):
-        return JSONResponse({"success": False, "error": "Аккаунт не определён"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "Аккаунт не определён"}, status_code=400)
     
     token = acc["access_token"]
     account_id = acc["account_id"]
     
     dict_id = await ensure_dictionary(token, account_id)
     if not dict_id:
-        return JSONResponse({"success": False, "error": "Нет справочника"})
+        return ORJSONResponse({"success": False, "error": "Нет справочника"})
     
     cat = await add_expense_category(token, dict_id, name)
     if cat:
-        return JSONResponse({"success": True, "category": cat})
-    return JSONResponse({"success": False, "error": "Ошибка создания"})
+        return ORJSONResponse({"success": True, "category": cat})
+    return ORJSONResponse({"success": False, "error": "Ошибка создания"})
 
 
 @app.post("/api/save-telegram")
 async def api_save_telegram(request: Request):
-    body = await request.json()
+    body = await read_json_body(request)
     telegram_username = body.get("telegramUsername", "").strip()
     
     acc = await resolve_account(request)
     if not acc:
-        return JSONResponse({"success": False, "error": "Аккаунт не определён"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "Аккаунт не определён"}, status_code=400)
     
     save_user_telegram(acc["account_id"], telegram_username)
-    return JSONResponse({"success": True})
+    return ORJSONResponse({"success": True})
 
 
 @app.get("/api/check-telegram")
 async def check_telegram(request: Request):
     username = request.query_params.get("username", "").lstrip("@")
     if not username:
-        return JSONResponse({"registered": False, "error": "Username не указан"})
+        return ORJSONResponse({"registered": False, "error": "Username не указан"})
     chat_id = get_telegram_chat_id(username)
-    return JSONResponse({"registered": chat_id is not None, "username": username})
+    return ORJSONResponse({"registered": chat_id is not None, "username": username})
 
 
 @app.post("/api/process-expenses")
 async def process_expenses(request: Request):
-    body = await request.json()
+    body = await read_json_body(request)
     expenses = body.get("expenses", [])
     category = body.get("category", "Накладные расходы")
     year = body.get("year", now_msk().year)
@@ -997,14 +1477,13 @@ async def process_expenses(request: Request):
 
     acc = await resolve_account(request)
     if not acc or not acc.get("access_token"):
-        return JSONResponse({"success": False, "error": "Аккаунт не определён"}, status_code=400)
+        return ORJSONResponse({"success": False, "error": "Аккаунт не определён"}, status_code=400)
 
     token = acc["access_token"]
     account_id = acc["account_id"]
     account_name = acc.get("account_name", "")
 
-    doc_type_names = {'demand': 'Отгрузки', 'supply': 'Приёмки', 'move': 'Перемещения'}
-    doc_type_name = doc_type_names.get(doc_type, 'Документы')
+    doc_type_name = DOC_TYPE_NAMES.get(doc_type, 'Документы')
 
     if telegram_username:
         save_user_telegram(account_id, telegram_username)
@@ -1061,42 +1540,114 @@ async def process_expenses(request: Request):
         start_msg += f"\n⏳ Пожалуйста, подождите..."
         await notify_user_by_username(telegram_username, start_msg)
 
-    # Обработка
-    for idx, item in enumerate(expenses, 1):
+    distribution = (distribution or "price").strip().lower()
+    if distribution not in DISTRIBUTIONS:
+        distribution = "price"
+
+    # Обработка: документы ищутся параллельно (не более PROCESS_CONCURRENCY запросов),
+    # затем все изменения уходят в МойСклад массовыми запросами
+    semaphore = asyncio.Semaphore(PROCESS_CONCURRENCY)
+    # Одна отметка времени на весь пакет — для комментариев в документах
+    batch_timestamp = now_msk().strftime("%d.%m.%Y %H:%M")
+    # Номер, встречающийся в файле несколько раз, ищется в МойСклад один раз: num -> задача поиска
+    searches = {}
+
+    # Сначала точные совпадения для всех номеров пачками, по одному ищем только остальные
+    numbers = list(dict.fromkeys(
+        (item.get("demandNumber", "") or "").strip()
+        for item in expenses
+        if parse_kopecks(item.get("expense", 0)) != 0
+    ))
+    numbers = [num for num in numbers if num]
+    prefetched = await search_documents_bulk(token, doc_type, numbers, year, semaphore) if numbers else {}
+
+    async def search(num: str, item_log: LogBuffer) -> dict:
+        document = prefetched.get(num)
+        if document is not None:
+            log_search_start(item_log, doc_type, num, year)
+            return search_found(num, document, item_log)
+        async with semaphore:
+            return await search_document_exact(token, doc_type, num, year, item_log)
+
+    async def find_item(idx: int, item: dict) -> Optional[dict]:
         num = (item.get("demandNumber", "") or "").strip()
 
         # значение может быть строкой, пустым и т.п.
-        try:
-            val = float(item.get("expense", 0) or 0)
-        except (TypeError, ValueError):
-            val = 0
+        kopecks = parse_kopecks(item.get("expense", 0))
+        val = kopecks / 100
 
         item_category = item.get("category") or category
 
         # ВАЖНО: теперь разрешаем отрицательные, пропускаем только 0
         if not num or val == 0:
-            continue
+            return None
 
+        row = {"num": num, "kopecks": kopecks, "category": item_category, "document": None,
+               "log": LogBuffer(currency)}
+        item_log = row["log"]
         sign = "+" if val > 0 else ""
-        proc_log.log("")
-        proc_log.log(f"[{idx}/{len(expenses)}] {num} — {sign}{val:,.2f} {currency} ({item_category})")
+        item_log.log("")
+        item_log.log(f"[{idx}/{len(expenses)}] {num} — {sign}{val:,.2f} {currency} ({item_category})")
 
-        search_result = await search_document_exact(token, doc_type, num, year, proc_log)
+        task = searches.get(num)
+        if task is None:
+            task = searches[num] = asyncio.ensure_future(search(num, item_log))
+        else:
+            item_log.log(f"🔍 {num}: используется поиск из этого же пакета")
 
-        if not search_result["found"]:
-            proc_log.log_error(num, val, search_result.get("error", "Не найден"))
-            continue
+        try:
+            search_result = await task
+        except Exception as e:
+            logger.exception(f"❌ Ошибка поиска {num}")
+            item_log.log_error(num, val, str(e))
+            return row
 
-        document = search_result["document"]
-        r = await update_document_overhead(token, doc_type, document["id"], val, item_category, proc_log, currency=currency, distribution=distribution)
+        if not search_result["found"]:
+            item_log.log_error(num, val, search_result.get("error", "Не найден"))
+            return row
+
+        row["document"] = search_result["document"]
+        return row
+
+    rows = [r for r in await asyncio.gather(*(find_item(idx, item) for idx, item in enumerate(expenses, 1))) if r]
+
+    # Строки одного документа объединяются в одно изменение (в порядке строк файла)
+    rows_by_document = {}
+    for row in rows:
+        if row["document"]:
+            rows_by_document.setdefault(row["document"]["id"], []).append(row)
+
+    updates = []
+    totals_by_document = []
+    for doc_rows in rows_by_document.values():
+        update, totals = build_overhead_update(
+            doc_rows[0]["document"],
+            [(row["kopecks"], row["category"]) for row in doc_rows],
+            currency, distribution, batch_timestamp
+        )
+        updates.append(update)
+        totals_by_document.append(totals)
+
+    update_errors = await bulk_update_documents(token, doc_type, updates) if updates else []
+
+    for doc_rows, totals, error in zip(rows_by_document.values(), totals_by_document, update_errors):
+        for row, total in zip(doc_rows, totals):
+            item_log = row["log"]
+            val = row["kopecks"] / 100
+            item_log.log(
+                f"📝 Обновление {row['document'].get('name', '')}: +{val:.2f} {currency} "
+                f"(было: {(total - row['kopecks']) / 100:.2f} {currency}), распределение={distribution}"
+            )
+            if error is None:
+                item_log.log_success(row["num"], val, total / 100)
+            else:
+                item_log.log_error(row["num"], val, error)
 
-        if r["success"]:
-            proc_log.log_success(num, val, r.get("total", 0))
-        else:
-            proc_log.log_error(num, val, r.get("error", "Ошибка обновления"))
+    for row in rows:
+        proc_log.merge(row["log"])
 
-    # Финализация
-    full_log = proc_log.finalize()
+    # Финализация (полный лог пишется на диск вне цикла событий)
+    full_log = await asyncio.to_thread(proc_log.finalize)
 
     # Telegram отчёт
     if telegram_username:
@@ -1111,7 +1662,7 @@ async def process_expenses(request: Request):
         await notify_user_by_username(telegram_username, telegram_report)
         await send_log_file_to_user(telegram_username, full_log, proc_log.log_filename)
 
-    return JSONResponse({
+    return ORJSONResponse({
         "success": True,
         "processed": len(proc_log.results),
         "errors": len(proc_log.errors),
@@ -1130,7 +1681,7 @@ async def process_expenses(request: Request):
 async def debug(request: Request):
     all_accounts = get_all_active_accounts()
     telegram_users = load_telegram_users()
-    return JSONResponse({
+    return ORJSONResponse({
         "all_active_accounts": [{"id": a.get("account_id"), "name": a.get("account_name")} for a in all_accounts],
         "total_active": len(all_accounts),
         "telegram_users_count": len(telegram_users.get("users", {})),
@@ -1141,19 +1692,20 @@ async def debug(request: Request):
 
 
 @app.get("/api/accounts")
-async def list_accounts():
+async def list_accounts(request: Request):
     accounts_data = load_accounts()
-    result = []
-    for acc_id, acc in accounts_data.get("accounts", {}).items():
-        saved_tg = get_user_telegram(acc_id)
-        result.append({
+    users = load_user_settings().get("users", {})
+    result = [
+        {
             "id": acc_id,
             "name": acc.get("account_name"),
             "status": acc.get("status"),
             "has_token": bool(acc.get("access_token")),
-            "telegram": saved_tg
-        })
-    return JSONResponse({"accounts": result})
+            "telegram": users.get(acc_id, {}).get("telegram_username", "")
+        }
+        for acc_id, acc in accounts_data.get("accounts", {}).items()
+    ]
+    return json_etag_response(request, {"accounts": result})
 
 
 @app.get("/api/currencies")
@@ -1173,7 +1725,7 @@ async def get_currencies():
         {"code": "TRY", "symbol": "₺", "name": "Турецкая лира"},
         {"code": "AED", "symbol": "د.إ", "name": "Дирхам ОАЭ"},
     ]
-    return JSONResponse({"currencies": currencies})
+    return ORJSONResponse({"currencies": currencies})
 
 
 # ============== Админ-эндпоинт: уведомить о всех активных аккаунтах ==============
@@ -1188,7 +1740,7 @@ async def admin_notify_active_accounts(request: Request):
     secret = request.query_params.get("secret", "")
     expected = os.getenv("ADMIN_SECRET", "")
     if expected and secret != expected:
-        return JSONResponse({"success": False, "error": "Forbidden"}, status_code=403)
+        return ORJSONResponse({"success": False, "error": "Forbidden"}, status_code=403)
 
     active_accounts = get_all_active_accounts()
     lines = [
@@ -1202,57 +1754,104 @@ async def admin_notify_active_accounts(request: Request):
         lines.append(f"... и ещё {len(active_accounts) - 30}")
 
     await notify_admin("\n".join(lines))
-    return JSONResponse({"success": True, "total": len(active_accounts)})
+    return ORJSONResponse({"success": True, "total": len(active_accounts)})
 
 
 # ============== Страницы ==============
 
+# Шаблоны не содержат динамического контекста — рендерим каждый один раз за процесс
+PAGE_CACHE_CONTROL = "public, max-age=3600"
+
+
+@lru_cache(maxsize=None)
+def render_static_page(template_name: str) -> tuple:
+    """Отрендерить шаблон в байты и посчитать ETag (один раз на шаблон)"""
+    body = templates.get_template(template_name).render().encode("utf-8")
+    return body, make_etag(body)
+
+
+def static_page_response(request: Request, template_name: str) -> Response:
+    body, etag = render_static_page(template_name)
+    return etag_response(request, body, HTMLResponse.media_type, PAGE_CACHE_CONTROL, etag)
+
+
 @app.get("/iframe", response_class=HTMLResponse)
 async def iframe_page(request: Request):
-    return templates.TemplateResponse("iframe.html", {"request": request})
+    return static_page_response(request, "iframe.html")
 
 
 @app.get("/widget-demand", response_class=HTMLResponse)
 async def widget_demand(request: Request):
-    return templates.TemplateResponse("widget_demand.html", {"request": request})
+    return static_page_response(request, "widget_demand.html")
 
 
 @app.get("/widget-supply", response_class=HTMLResponse)
 async def widget_supply(request: Request):
-    return templates.TemplateResponse("widget_supply.html", {"request": request})
+    return static_page_response(request, "widget_supply.html")
 
 
 @app.get("/widget-move", response_class=HTMLResponse)
 async def widget_move(request: Request):
-    return templates.TemplateResponse("widget_move.html", {"request": request})
+    return static_page_response(request, "widget_move.html")
+
+
+# Неизменная часть ответа "/" — меняется только число активных аккаунтов
+APP_INFO = {
+    "app": "Накладные расходы",
+    "version": "7.2",
+    "features": [
+        "demand", "supply", "move",
+        "telegram", "auto_categories",
+        "exact_match", "year_filter",
+        "multi_currency", "admin_notify"
+    ],
+    "supported_currencies": list(CURRENCY_SYMBOLS.keys())
+}
 
 
 @app.get("/")
 async def root():
-    all_accounts = get_all_active_accounts()
-    return {
-        "app": "Накладные расходы",
-        "version": "7.2",
-        "active_accounts": len(all_accounts),
-        "features": [
-            "demand", "supply", "move", 
-            "telegram", "auto_categories", 
-            "exact_match", "year_filter",
-            "multi_currency", "admin_notify"
-        ],
-        "supported_currencies": list(CURRENCY_SYMBOLS.keys())
-    }
+    return ORJSONResponse({**APP_INFO, "active_accounts": len(get_all_active_accounts())})
+
+
+# Тело ответа health-check не меняется — отдаём заранее собранный ответ
+HEALTH_RESPONSE = Response(content=b'{"status":"healthy"}', media_type="application/json")
 
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy"}
+    return HEALTH_RESPONSE
+
+
+# Заголовки для встраивания в iframe МойСклад — одинаковые для всех ответов,
+# поэтому собраны заранее в готовом для ASGI виде
+FRAME_HEADERS = (
+    (b"x-frame-options", b"ALLOWALL"),
+    (b"content-security-policy", b"frame-ancestors *"),
+    (b"access-control-allow-origin", b"*"),
+)
+
+
+class FrameHeadersMiddleware:
+    """ASGI-middleware: дописывает FRAME_HEADERS в начало ответа, не оборачивая тело"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                # Новый список: исходный может принадлежать закэшированному Response
+                message["headers"] = [*message.get("headers", ()), *FRAME_HEADERS]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
 
 
-@app.middleware("http")
-async def add_headers(request: Request, call_next):
-    response = await call_next(request)
-    response.headers["X-Frame-Options"] = "ALLOWALL"
-    response.headers["Content-Security-Policy"] = "frame-ancestors *"
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    return response
\ No newline at end of file
+app.add_middleware(FrameHeadersMiddleware)
+# Страницы и большие JSON-ответы (результаты обработки, списки статей) сжимаются
+app.add_middleware(GZipMiddleware, minimum_size=1024)